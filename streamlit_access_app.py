@@ -1,22 +1,36 @@
 import streamlit as st
 import pandas as pd
-import json
+import codecs
+import csv
+import mmap
+import orjson
 import os
+import pickle
 import random
-from openpyxl import load_workbook, Workbook
+import shutil
+import stat
+import tempfile
+import zipfile
+from openpyxl import load_workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
 from datetime import datetime
 from io import BytesIO
+from xml.sax.saxutils import escape
 
 # Constants
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_CONFIG = os.path.join(BASE_DIR, 'active_config.json')
 CODE_FILE = os.path.join(BASE_DIR, 'supervisor_codes.json')
+CODE_INDEX = os.path.join(BASE_DIR, 'supervisor_codes.idx')
 EXCEL_OUTPUT = os.path.join(BASE_DIR, 'access_review_log.xlsx')
+LOG_CSV = os.path.join(BASE_DIR, 'access_review_log.csv')
+XLSX_TEMPLATE = os.path.join(BASE_DIR, 'template.xlsx')
+SHEET_PART = 'xl/worksheets/sheet1.xml'
+TMP_PREFIX = 'access_review_tmp_'
+LOG_HEADERS = ['User ID', 'User Name', 'Role', 'Role Name', 'Supervisor', 'Action', 'Timestamp']
 
 # CSS Styling
-st.set_page_config(page_title="Access Review Portal", layout="centered")
-st.markdown(
-    """
+_CSS = """
     <style>
     /* Page background */
     .stApp {
@@ -47,29 +61,107 @@ st.markdown(
         outline: 2px solid #003366;
     }
     </style>
-    """, unsafe_allow_html=True
-)
+    """
+
+st.set_page_config(page_title="Access Review Portal", layout="centered")
+# Streamlit drops elements a rerun doesn't redraw, so the style tag is sent every run
+st.markdown(_CSS, unsafe_allow_html=True)
 
 # Utilities
-def generate_unique_code(existing):
-    while True:
-        code = str(random.randint(1000, 9999))
-        if code not in existing:
-            return code
+def generate_unique_codes(used, count):
+    available = [f"{n:04d}" for n in range(1000, 10000) if f"{n:04d}" not in used]
+    if count > len(available):
+        return None
+    random.shuffle(available)
+    return available[:count]
+
+
+def _detect_encoding(sample):
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # Incremental decode so a character cut off at the end of the sample isn't an error
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'ISO-8859-1'
+
+
+def read_csv_sniffed(path, **kwargs):
+    with open(path, 'rb') as f:
+        encoding = _detect_encoding(f.read(4096))
+    try:
+        return pd.read_csv(path, encoding=encoding, **kwargs)
+    except UnicodeDecodeError:
+        # Non-UTF-8 bytes past the sniffed sample
+        return pd.read_csv(path, encoding='ISO-8859-1', **kwargs)
+
+
+def replace_keeping_mode(tmp, path):
+    # mkstemp files are owner-only; keep the target's permissions (or a normal 0644)
+    mode = stat.S_IMODE(os.stat(path).st_mode) if os.path.exists(path) else 0o644
+    os.chmod(tmp, mode)
+    os.replace(tmp, path)
+
+
+def write_file_atomic(path, data):
+    # Write to a private temp file beside the target and swap it in, so readers
+    # never see a partial file and concurrent writers never share one
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TMP_PREFIX)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        replace_keeping_mode(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def write_json_atomic(path, obj):
+    write_file_atomic(path, orjson.dumps(obj, option=orjson.OPT_INDENT_2))
 
 
 def load_active_csv_path():
     if not os.path.exists(DATA_CONFIG):
         st.error("No active config found. Upload a CSV first.")
         st.stop()
-    with open(DATA_CONFIG, 'r') as f:
-        config = json.load(f)
+    with open(DATA_CONFIG, 'rb') as f:
+        config = orjson.loads(f.read())
     return config.get('active_csv')
 
 
+@st.cache_data(show_spinner=False, max_entries=1)
+def _load_dataframe_cached(path, mtime):
+    # Low-cardinality columns: compare on category codes instead of strings
+    df = read_csv_sniffed(
+        path, engine='c', memory_map=True,
+        dtype={c: 'category' for c in ('Supervisor', 'Role', 'Role Name')}
+    )
+    # One row per user/role per supervisor, so lookups below are plain slices
+    df = df.drop_duplicates(subset=['Supervisor', 'User ID', 'Role'], ignore_index=True)
+    # Row positions per supervisor, so lookups don't scan the whole frame
+    sup_index = df.groupby('Supervisor', observed=True).indices
+    return df, sup_index
+
+
 def load_dataframe():
     csv_path = load_active_csv_path()
-    return pd.read_csv(csv_path, encoding='ISO-8859-1')
+    return _load_dataframe_cached(csv_path, os.path.getmtime(csv_path))
+
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def _load_teams(path, mtime):
+    df, sup_index = _load_dataframe_cached(path, mtime)
+    cols = ['User ID', 'User Name', 'Role', 'Role Name']
+    return {
+        sup: list(df.iloc[rows][cols].itertuples(index=False, name=None))
+        for sup, rows in sup_index.items()
+    }
+
+
+def get_team(sup):
+    csv_path = load_active_csv_path()
+    return _load_teams(csv_path, os.path.getmtime(csv_path)).get(sup, [])
 
 
 def load_or_create_codes(df):
@@ -87,54 +179,113 @@ def load_or_create_codes(df):
     # 4) Load or build the code map
     code_map = {}
     if os.path.exists(CODE_FILE):
-        with open(CODE_FILE, 'r') as f:
-            code_map = json.load(f)
-    for sup in supervisors:
-        if sup not in code_map:
-            code_map[sup] = generate_unique_code(code_map.values())
-
-    with open(CODE_FILE, 'w') as f:
-        json.dump(code_map, f, indent=2)
+        with open(CODE_FILE, 'rb') as f:
+            code_map = orjson.loads(f.read())
+    new_sups = [sup for sup in supervisors if sup not in code_map]
+    if new_sups:
+        new_codes = generate_unique_codes(set(code_map.values()), len(new_sups))
+        if new_codes is None:
+            st.error("Not enough unused 4-digit access codes for all supervisors.")
+            st.stop()
+        code_map.update(zip(new_sups, new_codes))
+
+    write_json_atomic(CODE_FILE, code_map)
+    # Precomputed code -> supervisor lookup for the review tab
+    write_file_atomic(CODE_INDEX, pickle.dumps({v: k for k, v in code_map.items()}, protocol=pickle.HIGHEST_PROTOCOL))
 
     return code_map
 
 
 
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _load_code_index(mtime):
+    # Use the pickled index unless the JSON has been edited since it was written
+    if os.path.exists(CODE_INDEX) and os.path.getmtime(CODE_INDEX) >= mtime:
+        try:
+            with open(CODE_INDEX, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return pickle.loads(mm)
+        except (ValueError, EOFError, pickle.UnpicklingError):
+            # Empty or truncated index; the JSON is still authoritative
+            pass
+    with open(CODE_FILE, 'rb') as f:
+        code_map = orjson.loads(f.read())
+    return {sup_code: sup for sup, sup_code in code_map.items()}
+
+
 def find_supervisor_by_code(code):
     if not os.path.exists(CODE_FILE):
         return None
-    with open(CODE_FILE, 'r') as f:
-        code_map = json.load(f)
-    return next((sup for sup, sup_code in code_map.items() if sup_code == code), None)
+    return _load_code_index(os.path.getmtime(CODE_FILE)).get(code)
 
 
-def log_actions(supervisor, approved, removed, df):
+def log_actions(supervisor, approved, removed, df, sup_index):
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    sup_df = df[df['Supervisor'] == supervisor][['User ID', 'User Name', 'Role', 'Role Name']].drop_duplicates()
-    records = []
-    for action, lst in [('Approved', approved), ('Removed', removed)]:
-        for entry in lst:
-            uid, _ = entry.split(' - ', 1)
-            match = sup_df[sup_df['User ID'] == uid]
-            if not match.empty:
-                row = match.iloc[0].to_dict()
-                row.update({'Supervisor': supervisor, 'Action': action, 'Timestamp': timestamp})
-                records.append(row)
-    if not records:
+    sup_df = df.iloc[sup_index.get(supervisor, [])][['User ID', 'User Name', 'Role', 'Role Name']]
+    if not approved and not removed:
         return
-    if not os.path.exists(EXCEL_OUTPUT):
-        wb = Workbook()
-        ws = wb.active
-        ws.append(['User ID', 'User Name', 'Role', 'Role Name', 'Supervisor', 'Action', 'Timestamp'])
-        for rec in records:
-            ws.append([rec['User ID'], rec['User Name'], rec['Role'], rec['Role Name'], rec['Supervisor'], rec['Action'], rec['Timestamp']])
-        wb.save(EXCEL_OUTPUT)
-    else:
-        wb = load_workbook(EXCEL_OUTPUT)
-        ws = wb.active
-        for rec in records:
-            ws.append([rec['User ID'], rec['User Name'], rec['Role'], rec['Role Name'], rec['Supervisor'], rec['Action'], rec['Timestamp']])
-        wb.save(EXCEL_OUTPUT)
+    # approved/removed are (User ID, Role) pairs, so each role row is logged as chosen
+    actions = pd.DataFrame(approved + removed, columns=['User ID', 'Role'])
+    actions['User ID'] = actions['User ID'].astype(sup_df['User ID'].dtype)
+    actions['Action'] = ['Approved'] * len(approved) + ['Removed'] * len(removed)
+    records = actions.merge(sup_df, on=['User ID', 'Role'], how='inner')
+    if records.empty:
+        return
+    records['Supervisor'] = supervisor
+    records['Timestamp'] = timestamp
+    # Append-only CSV log; the XLSX is only built when the admin downloads it
+    new_log = not os.path.exists(LOG_CSV)
+    with open(LOG_CSV, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        if new_log:
+            writer.writerow(LOG_HEADERS)
+            # Carry over entries from the old XLSX-only log
+            if os.path.exists(EXCEL_OUTPUT):
+                wb = load_workbook(EXCEL_OUTPUT, read_only=True)
+                writer.writerows(wb.active.iter_rows(min_row=2, values_only=True))
+                wb.close()
+        writer.writerows(records[LOG_HEADERS].itertuples(index=False, name=None))
+
+
+def _inline_cell(v):
+    # Drop control characters XML 1.0 can't hold; keep edge whitespace like openpyxl does
+    v = ILLEGAL_CHARACTERS_RE.sub('', v)
+    space = ' xml:space="preserve"' if v != v.strip() else ''
+    return f'<c t="inlineStr"><is><t{space}>{escape(v)}</t></is></c>'
+
+
+def _sheet_xml(rows):
+    yield ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+           '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+    for r, row in enumerate(rows, 1):
+        cells = ''.join(_inline_cell(v) for v in row)
+        yield f'<row r="{r}">{cells}</row>'
+    yield '</sheetData></worksheet>'
+
+
+def build_log_xlsx():
+    # Copy the empty template package and stream the log in as the sheet XML,
+    # straight to disk so memory use doesn't grow with the log. Each rebuild
+    # gets its own temp file so concurrent sessions can't interleave writes.
+    fd, tmp = tempfile.mkstemp(dir=BASE_DIR, prefix=TMP_PREFIX, suffix='.xlsx')
+    try:
+        with os.fdopen(fd, 'wb') as raw, zipfile.ZipFile(XLSX_TEMPLATE) as src, \
+                zipfile.ZipFile(raw, 'w', zipfile.ZIP_DEFLATED) as dst:
+            for item in src.infolist():
+                if item.filename != SHEET_PART:
+                    dst.writestr(item, src.read(item.filename))
+            with open(LOG_CSV, newline='', encoding='utf-8') as f, dst.open(SHEET_PART, 'w') as out:
+                # Hand the compressor a few hundred KB at a time rather than one row
+                batch = []
+                for chunk in _sheet_xml(csv.reader(f)):
+                    batch.append(chunk)
+                    if len(batch) >= 1000:
+                        out.write(''.join(batch).encode('utf-8'))
+                        batch.clear()
+                out.write(''.join(batch).encode('utf-8'))
+        replace_keeping_mode(tmp, EXCEL_OUTPUT)
+    except BaseException:
+        os.remove(tmp)
+        raise
 
 # Session state defaults
 for key, default in [('supervisor', None), ('review_started', False), ('review_complete', False), ('approved', []), ('removed', [])]:
@@ -160,22 +311,37 @@ with tabs[0]:
                 st.error("Invalid access code.")
     elif st.session_state.review_started and not st.session_state.review_complete:
         sup = st.session_state.supervisor
-        df = load_dataframe()
-        emps = df[df['Supervisor'] == sup][['User ID','User Name','Role','Role Name']].drop_duplicates()
+        df, sup_index = load_dataframe()
+        team = get_team(sup)
         st.success(f"Welcome, {sup}. Review your team’s access:")
+        df_display = pd.DataFrame({
+            'User ID': [uid for uid, _, _, _ in team],
+            'Label': [f"{uid} - {uname}" for uid, uname, _, _ in team],
+            'Role': [role for _, _, role, _ in team],
+            'Role Name': [role_name for _, _, _, role_name in team],
+            'Approve': False,
+            'Remove': False,
+        })
         with st.form("access_form"):
             approve_all = st.checkbox("Approve all", key='approve_all')
-            approve, remove = [], []
-            for i, row in emps.iterrows():
-                label = f"{row['User ID']} - {row['User Name']}"
-                c1, c2 = st.columns(2)
-                with c1:
-                    if st.checkbox("Approve", key=f"a_{i}", value=approve_all): approve.append(label)
-                with c2:
-                    if st.checkbox("Remove", key=f"r_{i}"): remove.append(label)
-                st.markdown(f"**{label}** | {row['Role']} - {row['Role Name']}")
+            # User ID is carried but hidden, so each row maps back to its (User ID, Role)
+            edited = st.data_editor(
+                df_display, disabled=['User ID', 'Label', 'Role', 'Role Name'],
+                column_order=['Label', 'Role', 'Role Name', 'Approve', 'Remove'],
+                hide_index=True, key='review_editor'
+            )
             if st.form_submit_button("Submit Review"):
-                log_actions(sup, approve, remove, df)
+                # "Approve all" covers every row not explicitly marked for removal
+                approved_col, removed_col = edited['Approve'].astype(bool), edited['Remove'].astype(bool)
+                approve_mask = approved_col | (approve_all & ~removed_col)
+                approve = edited.loc[approve_mask, 'Label'].tolist()
+                remove = edited.loc[removed_col, 'Label'].tolist()
+                log_actions(
+                    sup,
+                    list(edited.loc[approve_mask, ['User ID', 'Role']].itertuples(index=False, name=None)),
+                    list(edited.loc[removed_col, ['User ID', 'Role']].itertuples(index=False, name=None)),
+                    df, sup_index
+                )
                 st.session_state.approved, st.session_state.removed = approve, remove
                 st.session_state.review_complete = True
                 st.rerun()
@@ -223,17 +389,22 @@ with tabs[1]:
                 st.warning("Please select at least one CSV file.")
             else:
                 all_dfs = []
-                file_data = []
                 expected_cols = None
+                dtypes = None
+
+                data_dir = os.path.join(BASE_DIR, 'data')
+                os.makedirs(data_dir, exist_ok=True)
 
-                # Read and normalize each CSV
+                # Persist each raw upload, then read and normalize it from disk
                 for idx, uploaded in enumerate(uploaded_files):
-                    data_bytes = uploaded.read()
+                    dest = os.path.join(data_dir, uploaded.name)
+                    uploaded.seek(0)
+                    with open(dest, 'wb') as f:
+                        shutil.copyfileobj(uploaded, f, length=1 << 20)
                     if idx == 0:
                         # first file: read normally
-                        df_part = pd.read_csv(
-                            BytesIO(data_bytes),
-                            encoding='ISO-8859-1',
+                        df_part = read_csv_sniffed(
+                            dest,
                             engine='python',
                             on_bad_lines='skip'
                         )
@@ -244,44 +415,47 @@ with tabs[1]:
                                 .str.strip()
                         )
                         expected_cols = df_part.columns.tolist()
+                        dtypes = df_part.dtypes.astype(str).to_dict()
                     else:
                         # subsequent files: skip their header row, enforce columns
-                        df_part = pd.read_csv(
-                            BytesIO(data_bytes),
-                            encoding='ISO-8859-1',
-                            engine='python',
-                            on_bad_lines='skip',
-                            header=None,
-                            names=expected_cols,
-                            skiprows=1
-                        )
+                        # and the first file's dtypes with the C parser
+                        try:
+                            df_part = read_csv_sniffed(
+                                dest,
+                                engine='c',
+                                memory_map=True,
+                                dtype=dtypes,
+                                usecols=expected_cols,
+                                header=None,
+                                names=expected_cols,
+                                skiprows=1
+                            )
+                        except (ValueError, OverflowError):
+                            # malformed rows (ParserError is a ValueError) or values that don't fit the dtypes
+                            df_part = read_csv_sniffed(
+                                dest,
+                                engine='python',
+                                on_bad_lines='skip',
+                                header=None,
+                                names=expected_cols,
+                                skiprows=1
+                            )
                     all_dfs.append(df_part)
-                    file_data.append((uploaded.name, data_bytes))
 
                 if not all_dfs:
                     st.error("No valid CSV files could be parsed.")
                     st.stop()
 
-                # Concatenate into one DataFrame
-                df = pd.concat(all_dfs, ignore_index=True)
-
-                # Persist raw uploads
-                data_dir = os.path.join(BASE_DIR, 'data')
-                os.makedirs(data_dir, exist_ok=True)
-                for name, bytes_data in file_data:
-                    dest = os.path.join(data_dir, name)
-                    with open(dest, 'wb') as f:
-                        f.write(bytes_data)
+                # Concatenate into one DataFrame (nothing to merge for a single file)
+                df = all_dfs[0] if len(all_dfs) == 1 else pd.concat(all_dfs, ignore_index=True, copy=False, sort=False)
 
                 # ───────────────────────────────────────────────────────────────
                 # 1) Save the merged DataFrame as a single “active” CSV
-                os.makedirs(data_dir, exist_ok=True)
                 merged_path = os.path.join(data_dir, 'active_combined.csv')
                 df.to_csv(merged_path, index=False, encoding='utf-8')
 
                 # 2) Tell the app to load that one from now on
-                with open(DATA_CONFIG, 'w') as f:
-                    json.dump({'active_csv': merged_path}, f)
+                write_json_atomic(DATA_CONFIG, {'active_csv': merged_path})
                 # ───────────────────────────────────────────────────────────────
 
 
@@ -306,6 +480,11 @@ with tabs[1]:
 
     # Step 3: Download review log
         st.subheader("Download Access Review Log")
+        # The CSV log is the source of truth; the XLSX is regenerated only when it is stale
+        if os.path.exists(LOG_CSV) and (
+            not os.path.exists(EXCEL_OUTPUT) or os.path.getmtime(EXCEL_OUTPUT) <= os.path.getmtime(LOG_CSV)
+        ):
+            build_log_xlsx()
         if os.path.exists(EXCEL_OUTPUT):
             with open(EXCEL_OUTPUT, 'rb') as f:
                 log_bytes = f.read()
@@ -317,5 +496,3 @@ with tabs[1]:
             )
         else:
             st.info("No reviews logged yet.")
-
-